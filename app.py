@@ -1,11 +1,21 @@
 import os
+import sys
+import re
 import json
+import time
+import hmac
+import queue
+import atexit
+import codecs
+import hashlib
+import secrets
 import random
+import threading
 import urllib.parse
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
-from flask import Flask, request, send_from_directory, abort
+from html.parser import HTMLParser
+from flask import Flask, request, send_from_directory, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, ImageSendMessage,
@@ -13,6 +23,8 @@ from linebot.models import (
 )
 from linebot.exceptions import LineBotApiError, InvalidSignatureError
 from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from zoneinfo import ZoneInfo
 
 # 使用環境變數來設定敏感資訊
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
@@ -64,9 +76,16 @@ except FileNotFoundError:
 with open(json_file_path, 'r', encoding='utf-8') as f:
     image_data = json.load(f)
 
-# 用戶狀態儲存
-user_states = {}
-user_last_image_index = {}
+# 圖片順序和編號索引，編號（小寫）-> 圖片在 image_data 中的位置
+image_keys = list(image_data.keys())
+image_id_index = {img['id'].lower(): index for index, img in enumerate(image_data.values())}
+
+# LINE 單次回覆最多可包含的訊息數量
+MAX_REPLY_MESSAGES = 5
+# 一次查詢最多送出的圖片數量，保留一則訊息放合併的說明
+MAX_BATCH_IDS = MAX_REPLY_MESSAGES - 1
+# 單一編號（a0001）或範圍（a0010-a0013）
+IMAGE_ID_PATTERN = re.compile(r'a(\d+)(?:-a?(\d+))?')
 
 # Google Sheets API 設定
 SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
@@ -76,58 +95,134 @@ SHEET_URL = os.getenv('SHEET_URL')  # Google Sheet 的網址
 # 定義檔案路徑
 incense_file_path = "assets/incense_data.json"
 
-# 初始化時間戳記錄
-user_timestamps = {}
+# 梗資料和搜尋索引，由 refresh_meme_data 增量更新
+meme_data = {}  # 重點摘要 -> 播出資訊
+meme_search_index = {}  # 重點摘要 -> 小寫的重點摘要，供搜尋比對
+meme_row_hashes = {}  # 重點摘要 -> 該列內容的雜湊值
+meme_data_lock = threading.Lock()
+
+class MemeTableParser(HTMLParser):
+    """以事件方式逐列讀取網頁中第一個表格，不建立整棵 DOM 樹"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.done = False
+        self.table_depth = 0
+        self.row = None
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            self.table_depth += 1
+        elif self.table_depth == 1:  # 忽略巢狀表格
+            if tag == 'tr':
+                self._close_row()
+                self.row = []
+            elif tag == 'td' and self.row is not None:
+                self._close_cell()
+                self.cell = []
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == 'table':
+            self.table_depth -= 1
+            if self.table_depth == 0:
+                self._close_row()
+                self.done = True
+        elif self.table_depth == 1:
+            if tag == 'td':
+                self._close_cell()
+            elif tag == 'tr':
+                self._close_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def _close_cell(self):
+        if self.cell is not None:
+            self.row.append(''.join(self.cell).strip())
+            self.cell = None
+
+    def _close_row(self):
+        if self.row is not None:
+            self._close_cell()
+            self.rows.append(self.row)
+            self.row = None
+
+def fetch_meme_rows():
+    # 串流讀取網頁並邊下載邊解析，讀完第一個表格就停止
+    parser = MemeTableParser()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # 確保正確處理中文
+    with requests.get(MEME_PAGE_URL, stream=True, timeout=10) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=16384):
+            parser.feed(decoder.decode(chunk))
+            if parser.done:
+                break
+        else:
+            parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    if not parser.rows and not parser.done:
+        return None
+    return parser.rows[1:]  # 跳過標題列
+
+def parse_meme_row(cols):
+    # 正確組合日期和時間
+    return {
+        "episode": cols[0],  # 集數
+        "first": f"{cols[2]} {cols[3]}".strip(),   # 首輪
+        "second": f"{cols[4]} {cols[5]}".strip(),  # 二輪
+        "third": f"{cols[6]} {cols[7]}".strip(),   # 三輪
+        "fourth": f"{cols[8]} {cols[9]}".strip(),  # 四輪
+        "fifth": f"{cols[10]} {cols[11]}".strip()  # 五輪
+    }
 
-def load_meme_data_from_web():
+def refresh_meme_data():
+    """重新讀取網頁，只更新新增、變更或刪除的列，回傳變更的重點摘要；讀取失敗時回傳 None"""
     try:
-        # 發送 GET 請求到網頁
-        response = requests.get(MEME_PAGE_URL)
-        response.encoding = 'utf-8'  # 確保正確處理中文
-        
-        # 使用 BeautifulSoup 解析網頁
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # 初始化 meme_data 字典
-        meme_data = {}
-        
-        # 解析表格
-        table = soup.find('table')
-        if not table:
-            print("找不到表格")
-            return {}
-            
-        rows = table.find_all('tr')[1:]  # 跳過標題列
-        for row in rows:
-            cols = row.find_all('td')
-            if len(cols) >= 12:  # 確保有足夠的欄位
-                episode = cols[0].text.strip()  # 集數
-                summary = cols[1].text.strip()  # 重點摘要
-                
-                # 正確組合日期和時間
-                first_round = f"{cols[2].text.strip()} {cols[3].text.strip()}"   # 首輪
-                second_round = f"{cols[4].text.strip()} {cols[5].text.strip()}"  # 二輪
-                third_round = f"{cols[6].text.strip()} {cols[7].text.strip()}"   # 三輪
-                fourth_round = f"{cols[8].text.strip()} {cols[9].text.strip()}"  # 四輪
-                fifth_round = f"{cols[10].text.strip()} {cols[11].text.strip()}" # 五輪
-                
-                if summary:  # 使用重點摘要作為 key
-                    meme_data[summary] = {
-                        "episode": episode,
-                        "first": first_round.strip(),
-                        "second": second_round.strip(),
-                        "third": third_round.strip(),
-                        "fourth": fourth_round.strip(),
-                        "fifth": fifth_round.strip()
-                    }
-        
-        return meme_data
+        rows = fetch_meme_rows()
     except Exception as e:
         print(f"讀取網頁資料時發生錯誤: {str(e)}")
-        return {}
+        return None
+    if rows is None:
+        print("找不到表格")
+        return None
+
+    # 計算每一列的雜湊值，重點摘要重複時以後面的列為準
+    new_rows = {}
+    for cols in rows:
+        if len(cols) >= 12 and cols[1]:  # 確保有足夠的欄位，並使用重點摘要作為 key
+            digest = hashlib.md5('\x1f'.join(cols[:12]).encode('utf-8')).hexdigest()
+            new_rows[cols[1]] = (digest, cols)
+
+    changes = {'added': [], 'changed': [], 'removed': []}
+    with meme_data_lock:
+        for summary, (digest, cols) in new_rows.items():
+            old_digest = meme_row_hashes.get(summary)
+            if old_digest == digest:
+                continue
+            changes['added' if old_digest is None else 'changed'].append(summary)
+            meme_data[summary] = parse_meme_row(cols)
+            meme_search_index[summary] = summary.lower()
+            meme_row_hashes[summary] = digest
+        for summary in [s for s in meme_row_hashes if s not in new_rows]:
+            changes['removed'].append(summary)
+            del meme_data[summary]
+            del meme_search_index[summary]
+            del meme_row_hashes[summary]
+
+    if any(changes.values()):
+        print(f"梗資料已更新：新增 {len(changes['added'])} 筆，"
+              f"變更 {len(changes['changed'])} 筆，刪除 {len(changes['removed'])} 筆")
+    return changes
 
 # 載入梗資料
-meme_data = load_meme_data_from_web()
+refresh_meme_data()
 
 # 定義狀態常量
 STATE_INIT = 'initial'
@@ -139,6 +234,88 @@ STATE_WAITING_SHOULD_I = 'waiting_should_i'
 STATE_WAITING_CHARACTER = 'waiting_character'
 STATE_WAITING_MEME = 'waiting_meme'  # 新增等待梗的狀態
 
+# 用戶 session 設定
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))  # 閒置多久後移除 session
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "10000"))  # 最多保留的 session 數量
+STATE_TIMEOUT_SECONDS = int(os.getenv("STATE_TIMEOUT_SECONDS", "300"))  # 等待輸入狀態的預設逾時
+# 個別狀態的逾時設定，未列出的狀態使用 STATE_TIMEOUT_SECONDS
+STATE_TIMEOUTS = {
+    STATE_WAITING_ID: int(os.getenv("STATE_TIMEOUT_WAITING_ID", str(STATE_TIMEOUT_SECONDS))),
+    STATE_WAITING_CHARACTER: int(os.getenv("STATE_TIMEOUT_WAITING_CHARACTER", str(STATE_TIMEOUT_SECONDS))),
+    STATE_WAITING_MEME: int(os.getenv("STATE_TIMEOUT_WAITING_MEME", str(STATE_TIMEOUT_SECONDS))),
+    STATE_WAITING_QUESTION: int(os.getenv("STATE_TIMEOUT_WAITING_QUESTION", str(STATE_TIMEOUT_SECONDS))),
+    STATE_WAITING_SHOULD_I: int(os.getenv("STATE_TIMEOUT_WAITING_SHOULD_I", str(STATE_TIMEOUT_SECONDS))),
+}
+
+class UserSession:
+    """單一用戶的對話狀態、圖片瀏覽位置和頻率限制記錄"""
+    __slots__ = (
+        'state', 'state_since', 'last_image_index', 'incense_timestamps',
+        'command_timestamps', 'limit_warning', 'last_seen'
+    )
+
+    def __init__(self, now):
+        self.state = STATE_INIT
+        self.state_since = now
+        self.last_image_index = None
+        self.incense_timestamps = []  # 上香時間戳
+        self.command_timestamps = []  # 指令時間戳
+        self.limit_warning = 0  # 上次超限提醒時間
+        self.last_seen = now
+
+    def get_state(self, now):
+        # 等待輸入的狀態超過逾時就回到初始狀態
+        if self.state != STATE_INIT:
+            timeout = STATE_TIMEOUTS.get(self.state, STATE_TIMEOUT_SECONDS)
+            if now - self.state_since > timeout:
+                self.state = STATE_INIT
+        return self.state
+
+    def set_state(self, state, now):
+        self.state = state
+        self.state_since = now
+
+class SessionStore:
+    """以 LRU 順序保存 session，閒置超過 TTL 或數量超過上限時移除最舊的 session"""
+
+    def __init__(self, ttl_seconds, max_users):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None or now - session.last_seen > self.ttl_seconds:
+                session = UserSession(now)
+                self.sessions[user_id] = session
+            session.last_seen = now
+            self.sessions.move_to_end(user_id)
+            self._evict(now)
+            return session
+
+    def _evict(self, now):
+        # 最久未使用的 session 在最前面，依序移除過期或超量的部分
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_users or now - session.last_seen > self.ttl_seconds:
+                del self.sessions[user_id]
+            else:
+                break
+
+    def __len__(self):
+        return len(self.sessions)
+
+user_sessions = SessionStore(SESSION_TTL_SECONDS, SESSION_MAX_USERS)
+
+def get_user_state(user_id):
+    return user_sessions.get(user_id).get_state(time.time())
+
+def set_user_state(user_id, state):
+    user_sessions.get(user_id).set_state(state, time.time())
+
 # 讀取上香次數和時間記錄
 def load_incense_count():
     try:
@@ -165,34 +342,456 @@ def save_incense_count(total_count, user_counts):
 # 初始化上香計數器和時間記錄
 total_incense_count, user_incense_counts = load_incense_count()
 
-# 用戶指令時間戳記錄
-user_command_timestamps = {}
-# 用戶超限提醒時間戳記錄
-user_limit_warnings = {}
-
 def check_command_rate_limit(user_id):
     current_time = datetime.now().timestamp()
     # 獲取用戶的指令時間戳記錄
-    if user_id not in user_command_timestamps:
-        user_command_timestamps[user_id] = []
+    session = user_sessions.get(user_id)
     
     # 清理超過10秒的記錄
     ten_seconds_ago = current_time - 10
-    user_command_timestamps[user_id] = [t for t in user_command_timestamps[user_id] if t > ten_seconds_ago]
+    session.command_timestamps = [t for t in session.command_timestamps if t > ten_seconds_ago]
     
     # 檢查10秒內的指令次數
-    if len(user_command_timestamps[user_id]) >= 7:
+    if len(session.command_timestamps) >= 7:
         # 檢查是否已經發送過警告
-        last_warning = user_limit_warnings.get(user_id, 0)
-        if current_time - last_warning > 10:  # 如果是新的超限週期
-            user_limit_warnings[user_id] = current_time
+        if current_time - session.limit_warning > 10:  # 如果是新的超限週期
+            session.limit_warning = current_time
             return False, "小主慢一點，朕跟不上了～請等待幾秒再試"
         return False, None  # 已經警告過，直接忽略
     
     # 記錄新的指令時間戳
-    user_command_timestamps[user_id].append(current_time)
+    session.command_timestamps.append(current_time)
     return True, None
 
+# 效能分析設定（預設關閉）
+# PROFILE_SAMPLE_RATE: 隨機抽樣分析的請求比例，例如 0.01 代表 1%
+# PROFILE_SLOW_MS: 超過此毫秒數的請求一律記錄，0 代表不使用
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # 堆疊取樣間隔
+PROFILE_FLUSH_SECONDS = int(os.getenv("PROFILE_FLUSH_SECONDS", "300"))  # 寫檔間隔
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "48"))  # 最多保留的分析檔數量
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # 管理端點的驗證碼，未設定時停用管理端點
+
+# 已知的特殊指令，用來將請求依指令分類
+SPECIAL_COMMANDS = {
+    "上香", "上香排行榜", "查梗", "列梗", "角色", "我該嗎", "看見甄相",
+    "每日運勢", "id", "menu", "抽", "下一張", "上一張"
+}
+
+def get_command_name(event):
+    # 依訊息內容和用戶狀態推斷這次請求屬於哪個指令，群組中未加前綴的訊息回傳 None
+    user_message = event.message.text.strip()
+    if event.source.type == 'group':
+        if not user_message.startswith('!'):
+            return None
+        user_message = user_message[1:]
+    user_message = user_message.lower()
+
+    if user_message in SPECIAL_COMMANDS:
+        return user_message
+    current_state = get_user_state(event.source.user_id)
+    if current_state != STATE_INIT:
+        return current_state
+    if parse_image_ids(user_message):
+        return 'id_search'
+    return 'keyword_search'
+
+class BackgroundFileWriter:
+    """背景寫檔共用的功能：第一次使用時啟動執行緒、程式結束時寫出剩餘資料、只保留最新的檔案
+
+    子類別需提供 thread、lock、output_dir、max_files 屬性和 _run、flush 方法
+    """
+    thread_name = 'background-writer'
+    file_suffix = ''
+
+    def _ensure_thread(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def _rotate(self):
+        files = sorted(f for f in os.listdir(self.output_dir) if f.endswith(self.file_suffix))
+        for file_name in files[:-self.max_files]:
+            os.remove(os.path.join(self.output_dir, file_name))
+
+class RequestProfiler(BackgroundFileWriter):
+    """以背景執行緒定時取樣堆疊的分析器，輸出 flamegraph 可用的 collapsed stack 格式"""
+    thread_name = 'request-profiler'
+    file_suffix = '.folded'
+
+    def __init__(self, sample_rate, slow_ms, interval_ms, flush_seconds, max_files, output_dir):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000
+        self.flush_seconds = flush_seconds
+        self.max_files = max_files
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.active = {}  # 執行緒 id -> 正在分析的請求
+        self.stacks = {}  # 指令 -> Counter(堆疊字串 -> 取樣次數)
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    def configure(self, sample_rate=None, slow_ms=None):
+        if sample_rate is not None:
+            self.sample_rate = max(0.0, min(1.0, sample_rate))
+        if slow_ms is not None:
+            self.slow_ms = max(0.0, slow_ms)
+
+    def begin(self, command):
+        self._ensure_thread()
+        record = {
+            'command': command,
+            'start': time.perf_counter(),
+            'stacks': Counter(),
+            'sampled': random.random() < self.sample_rate
+        }
+        # 沒被抽中且未設定延遲門檻的請求不會被保留，不需要取樣堆疊
+        if record['sampled'] or self.slow_ms > 0:
+            with self.lock:
+                self.active[threading.get_ident()] = record
+            self.wakeup.set()
+        return record
+
+    def end(self, record):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+        elapsed_ms = (time.perf_counter() - record['start']) * 1000
+        # 只保留被抽樣或超過延遲門檻的請求，其餘直接丟棄
+        if record['sampled'] or (self.slow_ms and elapsed_ms >= self.slow_ms):
+            with self.lock:
+                self.stacks.setdefault(record['command'], Counter()).update(record['stacks'])
+
+    def flush(self):
+        with self.lock:
+            stacks, self.stacks = self.stacks, {}
+        if not stacks:
+            return None
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            file_name = f"callback-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+            file_path = os.path.join(self.output_dir, file_name)
+            with open(file_path, 'a', encoding='utf-8') as f:
+                for command, counter in stacks.items():
+                    for stack, count in counter.items():
+                        # 以指令作為最上層的 frame，方便在 flamegraph 中依指令區分
+                        f.write(f"{command};{stack} {count}\n")
+            self._rotate()
+            return file_path
+        except Exception as e:
+            print(f"寫入效能分析檔案時發生錯誤: {str(e)}")
+            return None
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            if self.active:
+                time.sleep(self.interval)
+                frames = sys._current_frames()
+                with self.lock:
+                    for ident, record in self.active.items():
+                        frame = frames.get(ident)
+                        if frame is not None:
+                            record['stacks'][self._collapse(frame)] += 1
+                del frames
+            else:
+                # 沒有請求時休眠，直到下一個請求開始或需要寫檔
+                self.wakeup.wait(self.flush_seconds)
+                self.wakeup.clear()
+            if time.time() - last_flush >= self.flush_seconds:
+                self.flush()
+                last_flush = time.time()
+
+    @staticmethod
+    def _collapse(frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+request_profiler = RequestProfiler(
+    PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS, PROFILE_INTERVAL_MS,
+    PROFILE_FLUSH_SECONDS, PROFILE_MAX_FILES, PROFILE_DIR
+)
+
+# 使用紀錄設定
+EVENT_LOG_ENABLED = os.getenv("EVENT_LOG_ENABLED", "1") == "1"
+EVENT_LOG_BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH_SIZE", "200"))  # 累積多少筆寫入一次
+EVENT_LOG_FLUSH_SECONDS = float(os.getenv("EVENT_LOG_FLUSH_SECONDS", "5"))  # 最長多久寫入一次
+EVENT_LOG_MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 單一檔案大小上限
+EVENT_LOG_MAX_FILES = int(os.getenv("EVENT_LOG_MAX_FILES", "200"))  # 最多保留的紀錄檔數量
+EVENT_LOG_MAX_QUEUE = int(os.getenv("EVENT_LOG_MAX_QUEUE", "10000"))  # 佇列滿時丟棄新紀錄
+EVENT_LOG_DIR = os.path.join(DATA_DIR, 'events')
+EVENT_LOG_SALT_PATH = os.path.join(DATA_DIR, 'event_log_salt')
+# 紀錄檔依此時區的日期輪替，usage_report.py 也用同一個設定切分每日報表
+EVENT_LOG_TIMEZONE = ZoneInfo(os.getenv("EVENT_LOG_TIMEZONE", "Asia/Taipei"))
+
+def load_event_log_salt():
+    # 雜湊用戶 id 用的鹽值，未設定 EVENT_LOG_SALT 時第一次啟動產生並保存在資料目錄，之後沿用同一個
+    salt = os.getenv("EVENT_LOG_SALT")
+    if salt:
+        return salt
+    # 先寫入暫存檔再以 link 放到正式路徑，其他 worker 不會讀到寫到一半的檔案
+    temp_path = f"{EVENT_LOG_SALT_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(secrets.token_hex(16))
+    try:
+        os.link(temp_path, EVENT_LOG_SALT_PATH)
+    except FileExistsError:
+        pass  # 已有其他 worker 或先前的啟動產生過
+    finally:
+        os.remove(temp_path)
+    with open(EVENT_LOG_SALT_PATH, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+EVENT_LOG_SALT = load_event_log_salt()
+
+class EventDetails(threading.local):
+    """處理單一訊息時收集的細節，例如送出的圖片和查詢的角色"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.image_ids = []
+        self.character = None
+        self.shed = None  # 被降級處理時記錄處理方式
+
+event_details = EventDetails()
+
+class UsageEventLog(BackgroundFileWriter):
+    """由背景執行緒批次寫入的使用紀錄，每行一筆 JSON，檔案只會附加並依日期和大小輪替"""
+    thread_name = 'usage-event-log'
+    file_suffix = '.jsonl'
+
+    def __init__(self, output_dir, batch_size, flush_seconds, max_bytes, max_files, max_queue):
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = []  # 已從佇列取出、尚未寫入檔案的紀錄
+        self.pending_lock = threading.Lock()
+        self.dropped = 0  # 佇列已滿而丟棄的紀錄數量
+        self.reported_dropped = 0
+        self.file_path = None
+        self.file_day = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def log(self, command, state, event, latency_ms):
+        source = event.source
+        if source.type == 'group':
+            actor = source.group_id
+        elif source.type == 'room':
+            actor = source.room_id
+        else:
+            actor = source.user_id
+        record = {
+            't': round(time.time(), 3),
+            'c': command,
+            's': state,
+            'g': source.type,
+            'a': hash_actor(actor),
+            'ms': round(latency_ms, 1)
+        }
+        if event_details.image_ids:
+            record['i'] = event_details.image_ids
+        if event_details.character:
+            record['ch'] = event_details.character
+        if event_details.shed:
+            record['x'] = event_details.shed
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            with self.pending_lock:
+                self.pending.append(record)
+            deadline = time.time() + self.flush_seconds
+            while len(self.pending) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                with self.pending_lock:
+                    self.pending.append(record)
+            self._write_pending()
+
+    def flush(self):
+        # 將等待中的批次和佇列中剩下的紀錄立即寫入，程式結束時呼叫
+        with self.pending_lock:
+            while True:
+                try:
+                    self.pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+        self._write_pending()
+
+    def _write_pending(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        dropped = self.dropped
+        if dropped > self.reported_dropped:
+            print(f"使用紀錄佇列已滿，累計丟棄 {dropped} 筆紀錄")
+            self.reported_dropped = dropped
+        try:
+            with self.lock:
+                file_path = self._current_file()
+                with open(file_path, 'a', encoding='utf-8') as f:
+                    for record in batch:
+                        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        except Exception as e:
+            print(f"寫入使用紀錄時發生錯誤: {str(e)}")
+
+    def _current_file(self):
+        now = datetime.now(EVENT_LOG_TIMEZONE)
+        day = now.strftime('%Y%m%d')
+        if (self.file_path is None or self.file_day != day
+                or (os.path.exists(self.file_path) and os.path.getsize(self.file_path) >= self.max_bytes)):
+            os.makedirs(self.output_dir, exist_ok=True)
+            # 檔名包含行程 id，避免多個 worker 寫入同一個檔案
+            file_name = f"events-{now.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl"
+            self.file_path = os.path.join(self.output_dir, file_name)
+            self.file_day = day
+            self._rotate()
+        return self.file_path
+
+def hash_actor(actor_id):
+    # 只保存雜湊過的用戶或群組 id
+    return hashlib.sha256(f"{EVENT_LOG_SALT}:{actor_id}".encode('utf-8')).hexdigest()[:16]
+
+usage_event_log = UsageEventLog(
+    EVENT_LOG_DIR, EVENT_LOG_BATCH_SIZE, EVENT_LOG_FLUSH_SECONDS,
+    EVENT_LOG_MAX_BYTES, EVENT_LOG_MAX_FILES, EVENT_LOG_MAX_QUEUE
+)
+
+# 流量控制設定
+# 耗時的指令（呼叫 LINE profile API 或讀取網頁）和一般指令分開限制同時處理的數量
+COMMAND_CLASS_CHEAP = 'cheap'
+COMMAND_CLASS_EXPENSIVE = 'expensive'
+EXPENSIVE_COMMANDS = {"上香排行榜", STATE_WAITING_MEME}
+ADMISSION_LIMITS = {
+    COMMAND_CLASS_CHEAP: int(os.getenv("ADMISSION_CHEAP_LIMIT", "32")),
+    COMMAND_CLASS_EXPENSIVE: int(os.getenv("ADMISSION_EXPENSIVE_LIMIT", "4")),
+}
+# 額滿時最多等待多久（毫秒），0 代表不等待直接降級
+ADMISSION_WAIT_MS = {
+    COMMAND_CLASS_CHEAP: float(os.getenv("ADMISSION_CHEAP_WAIT_MS", "200")),
+    COMMAND_CLASS_EXPENSIVE: float(os.getenv("ADMISSION_EXPENSIVE_WAIT_MS", "0")),
+}
+BUSY_MESSAGE = "小主們太熱情了，朕一時忙不過來，請稍後再試～"
+
+def get_command_class(command):
+    return COMMAND_CLASS_EXPENSIVE if command in EXPENSIVE_COMMANDS else COMMAND_CLASS_CHEAP
+
+class AdmissionControl:
+    """依指令類別限制同時處理的請求數量，並統計放行和降級的次數"""
+
+    def __init__(self, limits, wait_ms):
+        self.limits = limits
+        self.waits = {command_class: wait / 1000 for command_class, wait in wait_ms.items()}
+        self.slots = {command_class: threading.BoundedSemaphore(limit) for command_class, limit in limits.items()}
+        self.in_flight = Counter()
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def acquire(self, command_class):
+        wait = self.waits[command_class]
+        if wait > 0:
+            acquired = self.slots[command_class].acquire(timeout=wait)
+        else:
+            acquired = self.slots[command_class].acquire(blocking=False)
+        with self.lock:
+            if acquired:
+                self.in_flight[command_class] += 1
+                self.counters[f"{command_class}.admitted"] += 1
+        return acquired
+
+    def release(self, command_class):
+        with self.lock:
+            self.in_flight[command_class] -= 1
+        self.slots[command_class].release()
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'limits': dict(self.limits),
+                'in_flight': dict(self.in_flight),
+                'counters': dict(self.counters)
+            }
+
+admission_control = AdmissionControl(ADMISSION_LIMITS, ADMISSION_WAIT_MS)
+
+@app.route("/admin/admission", methods=['GET'])
+def admin_admission():
+    check_admin_token()
+    snapshot = admission_control.snapshot()
+    snapshot['event_log_dropped'] = usage_event_log.dropped
+    return jsonify(snapshot)
+
+def check_admin_token():
+    # 未設定 ADMIN_TOKEN 時管理端點一律不存在
+    if not ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+
+@app.route("/admin/profile", methods=['GET', 'POST'])
+def admin_profile():
+    check_admin_token()
+    if request.method == 'POST':
+        try:
+            sample_rate = request.values.get('sample_rate')
+            slow_ms = request.values.get('slow_ms')
+            request_profiler.configure(
+                sample_rate=float(sample_rate) if sample_rate is not None else None,
+                slow_ms=float(slow_ms) if slow_ms is not None else None
+            )
+        except ValueError:
+            abort(400)
+        if request.values.get('flush'):
+            request_profiler.flush()
+    # 在鎖內取得快照，避免請求結束時同時新增指令
+    with request_profiler.lock:
+        pending_commands = sorted(request_profiler.stacks.keys())
+    return jsonify({
+        'enabled': request_profiler.enabled,
+        'sample_rate': request_profiler.sample_rate,
+        'slow_ms': request_profiler.slow_ms,
+        'output_dir': request_profiler.output_dir,
+        'pending_commands': pending_commands
+    })
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
@@ -223,7 +822,6 @@ def create_navigation_buttons(is_group=False):
 
 def send_image_by_index(event, index):
     user_id = event.source.user_id
-    image_keys = list(image_data.keys())
     if 0 <= index < len(image_keys):
         img = image_data[image_keys[index]]
         encoded_path = urllib.parse.quote(img['path'])
@@ -239,21 +837,86 @@ def send_image_by_index(event, index):
             quick_reply=create_navigation_buttons(is_group)
         )
         line_bot_api.reply_message(event.reply_token, [image_message, info_message])
-        user_last_image_index[user_id] = index
+        user_sessions.get(user_id).last_image_index = index
+        event_details.image_ids.append(img['id'])
     else:
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="沒有更多圖片了。")
         )
 
+def send_images_by_indexes(event, indexes, missing_ids=(), next_id=None):
+    # 將多張圖片放進同一則回覆，最後附上一則合併的說明
+    user_id = event.source.user_id
+    messages = []
+    caption = []
+    for index in indexes:
+        img = image_data[image_keys[index]]
+        encoded_path = urllib.parse.quote(img['path'])
+        image_url = f"{RENDER_EXTERNAL_URL}/images/{encoded_path}"
+        messages.append(ImageSendMessage(
+            original_content_url=image_url,
+            preview_image_url=image_url
+        ))
+        caption.append(f"【{img['id']}】 {img['name']}")
+        event_details.image_ids.append(img['id'])
+    if missing_ids:
+        caption.append(f"找不到：{'、'.join(missing_ids)}")
+    if next_id:
+        caption.append(f"一次最多 {MAX_BATCH_IDS} 個編號，{next_id} 之後的編號請再輸入一次")
+    # 檢查是否為群組訊息
+    is_group = event.source.type == 'group'
+    messages.append(TextSendMessage(
+        text="\n".join(caption),
+        quick_reply=create_navigation_buttons(is_group)
+    ))
+    line_bot_api.reply_message(event.reply_token, messages)
+    user_sessions.get(user_id).last_image_index = indexes[-1]
+
+def parse_image_ids(user_message):
+    """將「a0001 a0015」或「a0010-a0013」這類訊息展開成編號列表，不是編號格式時回傳 None
+
+    最多展開 MAX_BATCH_IDS + 1 個不重複的編號，多出的一個代表輸入被截斷，供回覆時提示從哪裡繼續
+    """
+    ids = {}
+    for token in re.split(r'[\s,，、]+', user_message.strip().lower()):
+        if not token:
+            continue
+        match = IMAGE_ID_PATTERN.fullmatch(token.lstrip('!'))
+        if not match:
+            return None
+        start, end = match.group(1), match.group(2)
+        if end is None:
+            numbers = [int(start)]
+        else:
+            first, last = sorted((int(start), int(end)))
+            numbers = range(first, last + 1)
+        for number in numbers:
+            # 超過上限就停止展開，避免超大範圍
+            if len(ids) > MAX_BATCH_IDS:
+                break
+            ids[f"a{number:0{len(start)}d}"] = None
+    if not ids:
+        return None
+    return list(ids)
+
 def handle_id_search(user_message, event):
     user_id = event.source.user_id
-    for index, (img_name, img) in enumerate(image_data.items()):
-        if img["id"].lower() == user_message.lower():
-            send_image_by_index(event, index)
-            user_states[user_id] = STATE_INIT
-            return True
-    return False
+    image_ids = parse_image_ids(user_message)
+    if not image_ids:
+        return False
+    next_id = image_ids[MAX_BATCH_IDS] if len(image_ids) > MAX_BATCH_IDS else None
+    image_ids = image_ids[:MAX_BATCH_IDS]
+    indexes = [image_id_index[image_id] for image_id in image_ids if image_id in image_id_index]
+    if not indexes:
+        return False
+    if len(image_ids) == 1:
+        send_image_by_index(event, indexes[0])
+    else:
+        missing_ids = [image_id for image_id in image_ids if image_id not in image_id_index]
+        send_images_by_indexes(event, indexes, missing_ids, next_id)
+    set_user_state(user_id, STATE_INIT)
+    return True
 
 def handle_keyword_search(user_message, event):
     try:
@@ -266,7 +929,7 @@ def handle_keyword_search(user_message, event):
             for img in matched_images:
                 message += f"【{img['id']}】 {img['name']}\n"
             message += "請輸入圖片編號來查看圖片。"
-            user_states[event.source.user_id] = STATE_WAITING_ID
+            set_user_state(event.source.user_id, STATE_WAITING_ID)
             # 檢查是否為群組訊息
             is_group = event.source.type == 'group'
             line_bot_api.reply_message(
@@ -291,10 +954,11 @@ def handle_keyword_search(user_message, event):
         )
         return False
 
-def handle_meme_search(user_message, event):
+def handle_meme_search(user_message, event, refresh=True):
     try:
-        # 每次搜尋時重新載入資料
-        meme_data = load_meme_data_from_web()
+        # 每次搜尋時更新有變動的資料，忙碌時直接使用已載入的資料
+        if refresh:
+            refresh_meme_data()
         if not meme_data:
             line_bot_api.reply_message(
                 event.reply_token,
@@ -305,16 +969,19 @@ def handle_meme_search(user_message, event):
         # 搜尋符合關鍵字的迷因
         matches = []
         search_term = user_message.lower()
-        for meme_name, info in meme_data.items():
-            if search_term in meme_name.lower():
-                message = f"重點摘要：{meme_name}\n"
-                message += f"集數：{info['episode']}\n"
-                message += f"首輪：{info['first']}\n"
-                message += f"二輪：{info['second']}\n"
-                message += f"三輪：{info['third']}\n"
-                message += f"四輪：{info['fourth']}\n"
-                message += f"五輪：{info['fifth']}"
-                matches.append(message)
+        with meme_data_lock:
+            candidates = [(meme_name, meme_data[meme_name])
+                          for meme_name, name_lower in meme_search_index.items()
+                          if search_term in name_lower]
+        for meme_name, info in candidates:
+            message = f"重點摘要：{meme_name}\n"
+            message += f"集數：{info['episode']}\n"
+            message += f"首輪：{info['first']}\n"
+            message += f"二輪：{info['second']}\n"
+            message += f"三輪：{info['third']}\n"
+            message += f"四輪：{info['fourth']}\n"
+            message += f"五輪：{info['fifth']}"
+            matches.append(message)
 
         if matches:
             response = "\n\n".join(matches)
@@ -335,7 +1002,7 @@ def handle_meme_search(user_message, event):
         )
     finally:
         # 重置狀態
-        user_states[event.source.user_id] = STATE_INIT
+        set_user_state(event.source.user_id, STATE_INIT)
 
 def handle_lottery(event):
     user_id = event.source.user_id
@@ -354,7 +1021,8 @@ def handle_lottery(event):
         quick_reply=create_navigation_buttons(is_group)  # 傳入群組狀態
     )
     line_bot_api.reply_message(event.reply_token, [image_message, info_message])
-    user_last_image_index[user_id] = random_index
+    user_sessions.get(user_id).last_image_index = random_index
+    event_details.image_ids.append(img['id'])
 
 def handle_character_search(user_message, event):
     try:
@@ -379,6 +1047,7 @@ def handle_character_search(user_message, event):
         print(f"找到 {len(matched_images)} 張匹配的圖片")  # 調試信息
         
         if matched_images:
+            event_details.character = user_message
             message = f"找到以下【{user_message}】的圖片：\n"
             for img in matched_images:
                 # 在群組中顯示時加上 ! 前綴
@@ -387,7 +1056,7 @@ def handle_character_search(user_message, event):
                 else:
                     message += f"【{img['id']}】 {img['name']}\n"
             message += "請輸入圖片編號來查看圖片。"
-            user_states[event.source.user_id] = STATE_WAITING_ID
+            set_user_state(event.source.user_id, STATE_WAITING_ID)
             
             # 只在私聊時添加快速回覆按鈕
             if event.source.type != 'group':
@@ -422,11 +1091,12 @@ def handle_character_search(user_message, event):
 def check_incense_limit(user_id):
     current_time = datetime.now().timestamp()
     # 獲取用戶的時間戳記錄，如果不存在則創建空列表
-    user_times = user_timestamps.get(user_id, [])
+    session = user_sessions.get(user_id)
     
     # 清理超過5分鐘的記錄
     five_minutes_ago = current_time - (5 * 60)
-    user_times = [t for t in user_times if t > five_minutes_ago]
+    session.incense_timestamps = [t for t in session.incense_timestamps if t > five_minutes_ago]
+    user_times = session.incense_timestamps
     
     # 檢查5分鐘內的上香次數
     if len(user_times) >= 5:
@@ -435,7 +1105,7 @@ def check_incense_limit(user_id):
     return True, None
 
 def handle_incense(event):
-    global total_incense_count, user_incense_counts, user_timestamps
+    global total_incense_count, user_incense_counts
     user_id = event.source.user_id
     
     # 檢查上香限制
@@ -454,9 +1124,7 @@ def handle_incense(event):
     
     # 更新時間戳記錄
     current_time = datetime.now().timestamp()
-    if user_id not in user_timestamps:
-        user_timestamps[user_id] = []
-    user_timestamps[user_id].append(current_time)
+    user_sessions.get(user_id).incense_timestamps.append(current_time)
     
     # 保存新的計數和時間戳
     save_incense_count(total_incense_count, user_incense_counts)
@@ -477,8 +1145,12 @@ def handle_incense(event):
                 text=f"已上香 {user_count} 次\n目前小主們共上香 {total_incense_count} 次"
             )
             line_bot_api.reply_message(event.reply_token, [image_message, count_message])
+            event_details.image_ids.append(img['id'])
             return
 
+# 最近一次產生的上香排行榜
+incense_ranking_cache = {}
+
 def handle_incense_ranking(event):
     # 取得前十名上香次數最多的使用者
     sorted_users = sorted(user_incense_counts.items(), key=lambda x: x[1], reverse=True)[:10]
@@ -505,6 +1177,9 @@ def handle_incense_ranking(event):
             
         ranking_message += f"{emoji} 第{i}名：{user_name} - {count}柱香\n"
     
+    # 保留最近一次的排行榜，忙碌時直接回覆
+    incense_ranking_cache['text'] = ranking_message
+    incense_ranking_cache['time'] = datetime.now()
     line_bot_api.reply_message(
         event.reply_token,
         TextSendMessage(text=ranking_message)
@@ -519,7 +1194,7 @@ def handle_special_commands(user_message, event):
         handle_incense_ranking(event)
         return True
     elif user_message.lower() == "查梗":
-        user_states[event.source.user_id] = STATE_WAITING_MEME
+        set_user_state(event.source.user_id, STATE_WAITING_MEME)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="請輸入要查詢的梗名稱：")
@@ -529,21 +1204,21 @@ def handle_special_commands(user_message, event):
         handle_list_memes(event)
         return True
     elif user_message.lower() == "角色":
-        user_states[event.source.user_id] = STATE_WAITING_CHARACTER
+        set_user_state(event.source.user_id, STATE_WAITING_CHARACTER)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="請輸入角色名稱來查詢圖片：")
         )
         return True
     elif user_message.lower() == "我該嗎":
-        user_states[event.source.user_id] = STATE_WAITING_SHOULD_I
+        set_user_state(event.source.user_id, STATE_WAITING_SHOULD_I)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="告訴朕你在猶豫什麼...")
         )
         return True
     elif user_message.lower() == "看見甄相":
-        user_states[event.source.user_id] = STATE_WAITING_QUESTION
+        set_user_state(event.source.user_id, STATE_WAITING_QUESTION)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="告訴朕你想問的問題...")
@@ -561,10 +1236,10 @@ def handle_special_commands(user_message, event):
                 break
         return True
     elif user_message.lower() == "id":
-        user_states[event.source.user_id] = STATE_WAITING_ID
+        set_user_state(event.source.user_id, STATE_WAITING_ID)
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text="請輸入圖片編號（例如：a0001）：")
+            TextSendMessage(text="請輸入圖片編號（例如：a0001，也可以一次輸入多個：a0001 a0015 或 a0010-a0013）：")
         )
         return True
     elif user_message.lower() == "menu":
@@ -573,12 +1248,14 @@ def handle_special_commands(user_message, event):
         handle_lottery(event)
         return True
     elif user_message.lower() == "下一張":
-        if user_id in user_last_image_index:
-            send_image_by_index(event, user_last_image_index[user_id] + 1)
+        last_image_index = user_sessions.get(user_id).last_image_index
+        if last_image_index is not None:
+            send_image_by_index(event, last_image_index + 1)
             return True
     elif user_message.lower() == "上一張":
-        if user_id in user_last_image_index:
-            send_image_by_index(event, user_last_image_index[user_id] - 1)
+        last_image_index = user_sessions.get(user_id).last_image_index
+        if last_image_index is not None:
+            send_image_by_index(event, last_image_index - 1)
             return True
     return False
 
@@ -609,7 +1286,9 @@ def handle_should_i_answer(event):
 
 def handle_list_memes(event):
     message = "目前所有的梗：\n"
-    for meme_key in meme_data.keys():
+    with meme_data_lock:
+        meme_keys = list(meme_data.keys())
+    for meme_key in meme_keys:
         message += f"- {meme_key}\n"
     message += "\n可使用「查梗」來查詢特定梗的詳細資訊"
     
@@ -618,8 +1297,110 @@ def handle_list_memes(event):
         TextSendMessage(text=message)
     )
 
+# 等待輸入狀態的處理函式，回傳 True 代表訊息已處理完畢並回到初始狀態
+def on_waiting_character(user_message, event):
+    handle_character_search(user_message, event)
+    return True
+
+def on_waiting_question(user_message, event):
+    handle_question_answer(event)
+    return True
+
+def on_waiting_should_i(user_message, event):
+    handle_should_i_answer(event)
+    return True
+
+def on_waiting_meme(user_message, event):
+    handle_meme_search(user_message, event)
+    return True
+
+def on_waiting_id(user_message, event):
+    # 找不到編號時繼續往下嘗試其他搜尋方式
+    return handle_id_search(user_message, event)
+
+STATE_HANDLERS = {
+    STATE_WAITING_CHARACTER: on_waiting_character,
+    STATE_WAITING_QUESTION: on_waiting_question,
+    STATE_WAITING_SHOULD_I: on_waiting_should_i,
+    STATE_WAITING_MEME: on_waiting_meme,
+    STATE_WAITING_ID: on_waiting_id,
+}
+
+def check_message_rate_limit(event):
+    # 檢查指令頻率限制，超過時回傳 False
+    can_command, limit_message = check_command_rate_limit(event.source.user_id)
+    if can_command:
+        return True
+    event_details.shed = 'rate_limited'  # 使用紀錄中標記為被頻率限制擋下
+    if limit_message:  # 只有在有訊息時才回覆
+        try:
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=limit_message)
+            )
+        except Exception as e:
+            print(f"回覆頻率限制提醒時發生錯誤: {str(e)}")
+    return False
+
+def shed_message(command, command_class, event):
+    # 同類指令處理中的數量已滿，能用已有資料回覆的就降級處理，否則請用戶稍後再試
+    try:
+        if command == "上香排行榜" and incense_ranking_cache:
+            decision = 'cached'
+            # 註明排行榜產生的時間，避免誤以為是最新的排行
+            minutes = int((datetime.now() - incense_ranking_cache['time']).total_seconds() // 60)
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=f"{incense_ranking_cache['text']}（{minutes} 分鐘前的排行）")
+            )
+        elif command == STATE_WAITING_MEME and meme_data:
+            decision = 'cached'
+            user_message = event.message.text.strip()
+            if event.source.type == 'group':
+                user_message = user_message[1:]
+            handle_meme_search(user_message, event, refresh=False)
+        else:
+            decision = 'busy'
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=BUSY_MESSAGE)
+            )
+    except Exception as e:
+        decision = 'failed'
+        print(f"降級處理時發生錯誤: {str(e)}")
+    admission_control.count(f"{command_class}.shed_{decision}")
+    event_details.shed = decision
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    command = get_command_name(event)
+    if command is None:
+        return  # 群組中未加前綴的訊息不處理
+
+    state = get_user_state(event.source.user_id)
+    event_details.reset()
+    command_class = get_command_class(command)
+    # 未啟用效能分析時不增加額外開銷
+    record = request_profiler.begin(command) if request_profiler.enabled else None
+    start = time.perf_counter()
+    try:
+        # 先檢查指令頻率限制，被擋下的訊息不佔用處理名額，也不會收到降級回覆
+        if not check_message_rate_limit(event):
+            return
+        if admission_control.acquire(command_class):
+            try:
+                process_message(event)
+            finally:
+                admission_control.release(command_class)
+        else:
+            shed_message(command, command_class, event)
+    finally:
+        if record is not None:
+            request_profiler.end(record)
+        if EVENT_LOG_ENABLED:
+            usage_event_log.log(command, state, event, (time.perf_counter() - start) * 1000)
+
+def process_message(event):
     user_message = event.message.text.strip()
     user_id = event.source.user_id
     
@@ -630,54 +1411,19 @@ def handle_message(event):
         user_message = user_message[1:]
 
     try:
-        # 檢查指令頻率限制
-        can_command, limit_message = check_command_rate_limit(user_id)
-        if not can_command:
-            if limit_message:  # 只有在有訊息時才回覆
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text=limit_message)
-                )
-            return
-
-        # 初始化用戶狀態
-        if user_id not in user_states:
-            user_states[user_id] = STATE_INIT
-
         # 處理特殊指令
         if handle_special_commands(user_message.lower(), event):
             return
             
-        # 根據用戶狀態處理不同的情況
-        current_state = user_states.get(user_id, STATE_INIT)
-        
-        if current_state == STATE_WAITING_CHARACTER:
-            handle_character_search(user_message, event)
-            user_states[user_id] = STATE_INIT
-            return
-            
-        elif current_state == STATE_WAITING_QUESTION:
-            handle_question_answer(event)
-            user_states[user_id] = STATE_INIT
-            return
-            
-        elif current_state == STATE_WAITING_SHOULD_I:
-            handle_should_i_answer(event)
-            user_states[user_id] = STATE_INIT
+        # 根據用戶狀態處理不同的情況，逾時的狀態會自動回到初始狀態
+        current_state = get_user_state(user_id)
+        state_handler = STATE_HANDLERS.get(current_state)
+        if state_handler and state_handler(user_message, event):
+            set_user_state(user_id, STATE_INIT)
             return
-            
-        elif current_state == STATE_WAITING_MEME:
-            handle_meme_search(user_message, event)
-            # 狀態會在 handle_meme_search 中被重置
-            return
-            
-        elif current_state == STATE_WAITING_ID:
-            if handle_id_search(user_message, event):
-                user_states[user_id] = STATE_INIT
-                return
         
-        # 檢查是否為圖片編號
-        if user_message.lower().startswith('a') and user_message[1:].isdigit():
+        # 檢查是否為圖片編號，可一次輸入多個編號或範圍
+        if parse_image_ids(user_message):
             if handle_id_search(user_message, event):
                 return
         
@@ -698,7 +1444,7 @@ def handle_message(event):
             TextSendMessage(text="處理訊息時發生錯誤，請稍後再試")
         )
         # 發生錯誤時也重置狀態
-        user_states[user_id] = STATE_INIT
+        set_user_state(user_id, STATE_INIT)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
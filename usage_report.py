@@ -0,0 +1,108 @@
+import os
+import json
+import glob
+import argparse
+import pandas as pd
+
+# 設定資料儲存路徑，和 app.py 相同
+# 如果在 Render 上執行，使用 /data 目錄；否則使用本地的 data 目錄
+if os.path.exists('/data'):
+    DATA_DIR = '/data'
+else:
+    DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+EVENT_LOG_DIR = os.path.join(DATA_DIR, 'events')
+REPORT_DIR = os.path.join(DATA_DIR, 'reports')
+json_file_path = os.path.join(os.path.dirname(__file__), 'assets', 'image_data.json')
+# 切分每日的時區，和 app.py 輪替紀錄檔使用同一個設定
+EVENT_LOG_TIMEZONE = os.getenv("EVENT_LOG_TIMEZONE", "Asia/Taipei")
+
+def load_events(event_dir, timezone):
+    # 讀取所有使用紀錄檔，略過寫到一半的最後一行
+    records = []
+    for file_path in sorted(glob.glob(os.path.join(event_dir, 'events-*.jsonl'))):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    if not records:
+        return pd.DataFrame(columns=['t', 'c', 's', 'g', 'a', 'ms', 'i', 'ch', 'x'])
+    events = pd.DataFrame.from_records(records)
+    for column in ('i', 'ch', 'x'):
+        if column not in events:
+            events[column] = None
+    # 以 EVENT_LOG_TIMEZONE 切分日期，和 app.py 輪替紀錄檔的日期一致
+    local_time = pd.to_datetime(events['t'], unit='s').dt.tz_localize('UTC').dt.tz_convert(timezone)
+    events['date'] = local_time.dt.strftime('%Y-%m-%d')
+    return events
+
+def load_image_info():
+    # 圖片編號 -> 名稱和角色
+    with open(json_file_path, 'r', encoding='utf-8') as f:
+        image_data = json.load(f)
+    return pd.DataFrame(
+        [(img['id'], img['name'], img.get('character', '')) for img in image_data.values()],
+        columns=['image_id', 'name', 'character']
+    )
+
+def top_stickers(events, image_info, top):
+    images = events[['date', 'i']].explode('i').dropna(subset=['i'])
+    images = images.rename(columns={'i': 'image_id'})
+    counts = images.groupby(['date', 'image_id']).size().reset_index(name='count')
+    counts = counts.merge(image_info, on='image_id', how='left')
+    counts = counts.sort_values(['date', 'count'], ascending=[True, False])
+    return counts.groupby('date').head(top).reset_index(drop=True)
+
+def top_characters(events, top):
+    searches = events[['date', 'ch']].dropna(subset=['ch']).rename(columns={'ch': 'character'})
+    counts = searches.groupby(['date', 'character']).size().reset_index(name='count')
+    counts = counts.sort_values(['date', 'count'], ascending=[True, False])
+    return counts.groupby('date').head(top).reset_index(drop=True)
+
+def command_mix(events):
+    # 被頻率限制擋下的訊息沒有實際處理，不計入指令分布
+    events = events[events['x'] != 'rate_limited']
+    mix = events.groupby(['date', 'c']).agg(
+        count=('c', 'size'),
+        users=('a', 'nunique'),
+        p50_ms=('ms', 'median'),
+        p95_ms=('ms', lambda x: x.quantile(0.95))
+    ).reset_index().rename(columns={'c': 'command'})
+    mix['share'] = (mix['count'] / mix.groupby('date')['count'].transform('sum')).round(4)
+    return mix.sort_values(['date', 'count'], ascending=[True, False]).reset_index(drop=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='統計使用紀錄，產生每日熱門圖片、熱門角色和指令分布報表')
+    parser.add_argument('--events', default=EVENT_LOG_DIR, help='使用紀錄資料夾')
+    parser.add_argument('--output', default=REPORT_DIR, help='報表輸出資料夾')
+    parser.add_argument('--days', type=int, default=0, help='只統計最近幾天，0 代表全部')
+    parser.add_argument('--top', type=int, default=20, help='每日列出前幾名')
+    parser.add_argument('--timezone', default=EVENT_LOG_TIMEZONE, help='切分每日的時區')
+    args = parser.parse_args()
+
+    events = load_events(args.events, args.timezone)
+    if events.empty:
+        print(f"找不到使用紀錄: {args.events}")
+        return
+    if args.days > 0:
+        dates = sorted(events['date'].unique())[-args.days:]
+        events = events[events['date'].isin(dates)]
+
+    reports = {
+        'top_stickers': top_stickers(events, load_image_info(), args.top),
+        'top_characters': top_characters(events, args.top),
+        'command_mix': command_mix(events)
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    for report_name, report in reports.items():
+        file_path = os.path.join(args.output, f"{report_name}.csv")
+        report.to_csv(file_path, index=False, encoding='utf-8-sig')
+        print(f"\n===== {report_name} =====")
+        print(report.to_string(index=False))
+        print(f"已輸出至 {file_path}")
+
+if __name__ == "__main__":
+    main()